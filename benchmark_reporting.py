@@ -0,0 +1,44 @@
+"""Benchmark the VAT report on a million line items."""
+from datetime import date, timedelta
+import io
+from random import choice, randint, random, seed
+import time
+
+from invoice_generator.reporting import VatReport
+
+
+def fake_invoices(n_lines, lines_per_invoice=20):
+    start = date(2021, 1, 1)
+    customers = [f"customer {i}" for i in range(500)]
+    for i in range(n_lines // lines_per_invoice):
+        yield {
+            "reference": f"2021-{i:06d}",
+            "emited": (start + timedelta(days=randint(0, 364))).isoformat(),
+            "customer": {"name": choice(customers)},
+            "prestations": [
+                {"title": f"prestation {j + 1}",
+                 "unit_price": round(random() * 100, 2),
+                 "quantity": randint(1, 10),
+                 "vat": choice([0.0, 5.5, 10.0, 20.0])}
+                for j in range(lines_per_invoice)
+            ]
+        }
+
+
+if __name__ == "__main__":
+    seed(0)
+    invoices = list(fake_invoices(1_000_000))
+
+    start = time.perf_counter()
+    report = VatReport.from_invoices(invoices)
+    loaded = time.perf_counter()
+    for by in [('month', 'rate'), ('customer', 'rate'), ('month',)]:
+        report.totals(by)
+    grouped = time.perf_counter()
+    report.to_csv(io.StringIO(), by=('month', 'customer', 'rate'))
+    written = time.perf_counter()
+
+    print(f"{len(report)} rows (invoice, VAT rate)")
+    print(f"load:     {loaded - start:.2f}s")
+    print(f"group x3: {grouped - loaded:.2f}s")
+    print(f"csv:      {written - grouped:.2f}s")
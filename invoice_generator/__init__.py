@@ -4,4 +4,16 @@ __author__ = """Thibault Grandjean"""
 __email__ = 'thibault@cornet-grandjean.com'
 __version__ = '0.1.0'
 
-from .invoice_generator import InvoiceGenerator  # noqa: F401
+import importlib
+import sys
+
+if sys.version_info < (3, 7):
+    from .invoice_generator import InvoiceGenerator  # noqa: F401
+else:
+    # Imported lazily, so the client of the render daemon starts without
+    # loading jinja2 and pydantic.
+    def __getattr__(name):
+        if name == 'InvoiceGenerator':
+            module = importlib.import_module('.invoice_generator', __name__)
+            return module.InvoiceGenerator
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
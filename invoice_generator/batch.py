@@ -0,0 +1,130 @@
+"""Render many invoices in a row."""
+import hashlib
+from pathlib import Path
+import re
+
+from .fragments import FragmentCache
+from .invoice_generator import InvoiceGenerator
+from .journal import DONE, input_hash
+from .manifest import Manifest
+
+
+def safe_name(name):
+    """Make a name usable as a file name inside the output directory.
+
+    Characters other than letters, digits, ``.``, ``-`` and ``_`` are
+    replaced and leading dots are removed, so the name can't point outside
+    of the directory. When the name is changed, a short hash of the original
+    name is appended so that different names, like ``FAC/1`` and ``FAC_1``,
+    don't end up in the same file.
+
+    :type name: str
+    :rtype: str
+    :raises ValueError: if nothing is left of the name.
+    """
+    safe = re.sub(r'[^\w.-]', '_', name).lstrip('.')
+    if not safe:
+        raise ValueError(f"Invalid invoice name {name!r}.")
+    if safe != name:
+        safe += '-' + hashlib.sha1(name.encode()).hexdigest()[:8]
+    return safe
+
+
+def invoice_name(invoice):
+    """Return the pdf name of an invoice in a batch, based on its reference.
+
+    :type invoice: Invoice
+    :rtype: str
+    """
+    return safe_name(invoice.reference)
+
+
+def render_batch(invoices,
+                 output_directory,
+                 template_dir=None,
+                 template_name=None,
+                 journal=None,
+                 clean=True,
+                 fragment_cache=None,
+                 layout=None,
+                 manifest=None):
+    """Render a batch of invoices, one pdf per invoice reference.
+
+    When a journal is given, invoices already rendered from the same input
+    are skipped, so an interrupted run can be resumed by running it again.
+    Failures don't stop the batch, they are returned and recorded in the
+    journal.
+
+    :param invoices: The invoices to render.
+    :type invoices: iterable of Invoice
+    :param output_directory: Path of output directory
+    :type output_directory: pathlib.Path or str
+    :param template_dir: See :class:`InvoiceGenerator`.
+    :param template_name: See :class:`InvoiceGenerator`.
+    :param journal: The checkpoint journal, defaults to None.
+    :type journal: Journal, optional
+    :param clean: Remove LaTeX auxiliary files, defaults to True.
+    :type clean: bool, optional
+    :param fragment_cache: The cache of rendered blocks, defaults to a new
+        cache for the batch.
+    :type fragment_cache: FragmentCache, optional
+    :param layout: The layout of the output directory, see
+        :class:`InvoiceGenerator`.
+    :type layout: str, optional
+    :param manifest: The manifest of the output directory, defaults to the
+        ``manifest.sqlite`` of the output directory when the layout is not
+        flat.
+    :type manifest: Manifest, optional
+    :return: A dict mapping the references of rendered invoices to their pdf
+        path, a dict mapping the references of failed invoices to the error
+        and a dict mapping the references of invoices skipped because another
+        worker is rendering them to that worker.
+    :rtype: tuple
+    """
+    if fragment_cache is None:
+        fragment_cache = FragmentCache()
+    own_manifest = manifest is None and layout not in (None, 'flat')
+    if own_manifest:
+        manifest = Manifest(output_directory)
+    try:
+        return _render_batch(invoices, output_directory, template_dir,
+                             template_name, journal, clean, fragment_cache,
+                             layout, manifest)
+    finally:
+        if own_manifest:
+            manifest.close()
+
+
+def _render_batch(invoices, output_directory, template_dir, template_name,
+                  journal, clean, fragment_cache, layout, manifest):
+    rendered, failed, skipped = {}, {}, {}
+    for invoice in invoices:
+        key = invoice.reference
+        if journal is not None:
+            digest = input_hash(invoice, template_dir, template_name, layout)
+            if not journal.claim(key, digest):
+                entry = journal.get(key)
+                if entry['status'] == DONE:
+                    rendered[key] = Path(entry['output'])
+                else:
+                    skipped[key] = entry['worker']
+                continue
+        try:
+            generator = InvoiceGenerator(invoice,
+                                         template_dir=template_dir,
+                                         template_name=template_name,
+                                         output_directory=output_directory,
+                                         invoice_name=invoice_name(invoice),
+                                         fragment_cache=fragment_cache,
+                                         layout=layout,
+                                         manifest=manifest)
+            path = generator.run(clean=clean)
+        except Exception as e:
+            failed[key] = e
+            if journal is not None:
+                journal.fail(key, digest, e)
+            continue
+        rendered[key] = path
+        if journal is not None:
+            journal.complete(key, digest, path)
+    return rendered, failed, skipped
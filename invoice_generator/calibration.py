@@ -0,0 +1,178 @@
+"""Find the fastest TeX engine for a template directory."""
+import argparse
+from datetime import date
+import json
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import warnings
+
+from .invoice_generator import (CALIBRATION_FILE, DEFAULT_TEMPLATE_DIR,
+                                ENGINES, InvoiceGenerator)
+from .models import Address, Customer, Issuer, Invoice, Prestation
+
+
+EXAMPLE_SIZES = (1, 8, 26)
+
+
+def installed_engines():
+    """List the engines of ``ENGINES`` that are installed on this host.
+
+    :rtype: list
+    """
+    return [engine for engine in ENGINES if shutil.which(engine)]
+
+
+def example_invoice(n_prestations):
+    """Build a representative invoice with ``n_prestations`` prestations.
+
+    The sizes used by the calibration are the ones of ``generate_examples.py``
+    covering the single page and multiple pages layouts.
+
+    :type n_prestations: int
+    :rtype: Invoice
+    """
+    address = Address(address='address', zip_code=75000, city="Paris")
+    issuer = Issuer(first_name="first_name",
+                    last_name="last_name",
+                    company_name="company_name",
+                    siret="siret",
+                    intracom_vat="intracom_vat",
+                    email="email@example.com",
+                    phone="phone number",
+                    address=address)
+    customer = Customer(first_name="first_name",
+                        last_name="last_name",
+                        address=address,
+                        phone="phone number",
+                        email="email@example.com")
+    prestations = [Prestation(quantity=i % 10 + 1,
+                              unit_price=(i * 7 % 100) / 10,
+                              title=f"prestation {i + 1}")
+                   for i in range(n_prestations)]
+    return Invoice(issuer=issuer,
+                   customer=customer,
+                   prestations=prestations,
+                   reference="reference",
+                   emited=date(2021, 10, 20))
+
+
+def pdf_summary(path):
+    """Return the page count and the text of a pdf.
+
+    :param path: Path of the pdf.
+    :return: The page count and the text with normalized whitespaces, or
+        None if poppler's ``pdfinfo`` and ``pdftotext`` are not installed.
+    :rtype: tuple
+    """
+    if not (shutil.which('pdfinfo') and shutil.which('pdftotext')):
+        return None
+    info = subprocess.run(['pdfinfo', str(path)],
+                          stdout=subprocess.PIPE, check=True).stdout.decode()
+    pages = int(re.search(r'^Pages:\s+(\d+)', info, re.MULTILINE).group(1))
+    text = subprocess.run(['pdftotext', str(path), '-'],
+                          stdout=subprocess.PIPE, check=True).stdout.decode()
+    return pages, ' '.join(text.split())
+
+
+def time_engine(engine, invoices, template_dir=None, template_name=None,
+                output_directory=None):
+    """Render invoices with an engine.
+
+    :return: The elapsed time in seconds and the summary of each pdf, see
+        :func:`pdf_summary`.
+    :rtype: tuple
+    """
+    summaries = []
+    elapsed = 0.0
+    for i, invoice in enumerate(invoices):
+        generator = InvoiceGenerator(invoice,
+                                     template_dir=template_dir,
+                                     template_name=template_name,
+                                     output_directory=output_directory,
+                                     invoice_name=f"{engine}_{i}",
+                                     engine=engine)
+        start = time.perf_counter()
+        path = generator.run()
+        elapsed += time.perf_counter() - start
+        summaries.append(pdf_summary(path))
+    return elapsed, summaries
+
+
+def calibrate(template_dir=None, template_name=None, engines=None,
+              sizes=EXAMPLE_SIZES):
+    """Time every installed engine and record the fastest one.
+
+    Each engine renders the example invoices; engines which fail or whose
+    output differs from the first engine's (page count and extracted text)
+    are discarded. The fastest remaining engine is written in the
+    ``engine.json`` file of the template directory, and used by default by
+    :class:`InvoiceGenerator` for this directory.
+
+    :param template_dir: See :class:`InvoiceGenerator`.
+    :param template_name: See :class:`InvoiceGenerator`.
+    :param engines: The engines to compare, defaults to the installed ones.
+    :type engines: list, optional
+    :param sizes: The number of prestations of each example invoice.
+    :type sizes: tuple, optional
+    :return: The calibration, with the fastest ``engine`` and the
+        ``timings`` of each valid engine.
+    :rtype: dict
+    """
+    engines = engines or installed_engines()
+    if not engines:
+        raise RuntimeError('No TeX engine is installed.')
+    template_dir = Path(template_dir or DEFAULT_TEMPLATE_DIR)
+    invoices = [example_invoice(size) for size in sizes]
+    timings = {}
+    reference = None
+    with tempfile.TemporaryDirectory() as output_directory:
+        for engine in engines:
+            try:
+                elapsed, summaries = time_engine(engine, invoices,
+                                                 template_dir, template_name,
+                                                 Path(output_directory))
+            except (ValueError, OSError):
+                warnings.warn(f"{engine} failed to compile the examples.")
+                continue
+            if None in summaries:
+                warnings.warn("pdfinfo and pdftotext are not installed, "
+                              "the outputs are not compared.")
+            elif reference is None:
+                reference = summaries
+            elif summaries != reference:
+                warnings.warn(f"{engine} output differs from "
+                              f"{next(iter(timings))}'s.")
+                continue
+            timings[engine] = elapsed
+    if not timings:
+        raise RuntimeError('No engine compiled the examples.')
+    calibration = {"engine": min(timings, key=timings.get),
+                   "timings": timings}
+    with open(template_dir / CALIBRATION_FILE, 'w') as file:
+        json.dump(calibration, file, indent=2)
+    return calibration
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=calibrate.__doc__
+                                     .splitlines()[0])
+    parser.add_argument('template_dir', nargs='?', default=None)
+    parser.add_argument('--template-name', default=None)
+    parser.add_argument('--engine', action='append', dest='engines',
+                        choices=list(ENGINES),
+                        help='engine to compare, can be repeated')
+    args = parser.parse_args(argv)
+    calibration = calibrate(args.template_dir, args.template_name,
+                            args.engines)
+    for engine, elapsed in sorted(calibration["timings"].items(),
+                                  key=lambda item: item[1]):
+        print(f"{engine:10} {elapsed:.2f}s")
+    print(f"default engine: {calibration['engine']}")
+
+
+if __name__ == '__main__':
+    main()
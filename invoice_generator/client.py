@@ -0,0 +1,99 @@
+"""Thin client of the render daemon.
+
+This module only uses the standard library, so calling it once per invoice
+doesn't pay for importing jinja2 and pydantic.
+"""
+import argparse
+import base64
+import json
+import os
+import socket
+import sys
+import tempfile
+
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'invoice-generator.sock')
+
+
+class RenderError(Exception):
+    """Raised when the daemon fails to render an invoice."""
+
+
+def _connect(socket_path=None, port=None):
+    if port is not None:
+        return socket.create_connection(('127.0.0.1', port))
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path or DEFAULT_SOCKET)
+    return connection
+
+
+def request(invoice, invoice_name=None, return_bytes=False,
+            socket_path=None, port=None):
+    """Ask the daemon to render an invoice.
+
+    :param invoice: The invoice, as a JSON string or as a dict.
+    :type invoice: str or dict
+    :param invoice_name: The name of the pdf, defaults to the name chosen by
+        the daemon.
+    :type invoice_name: str, optional
+    :param return_bytes: Return the content of the pdf instead of its path,
+        defaults to False.
+    :type return_bytes: bool, optional
+    :param socket_path: Path of the daemon Unix socket, defaults to
+        ``DEFAULT_SOCKET``.
+    :type socket_path: str, optional
+    :param port: Local TCP port of the daemon, used instead of the Unix
+        socket.
+    :type port: int, optional
+    :return: The path of the pdf, or its content.
+    :rtype: str or bytes
+    :raises RenderError: if the daemon failed to render the invoice.
+    """
+    if isinstance(invoice, str):
+        invoice = json.loads(invoice)
+    message = {"invoice": invoice,
+               "invoice_name": invoice_name,
+               "return": "bytes" if return_bytes else "path"}
+    with _connect(socket_path, port) as connection:
+        connection.sendall(json.dumps(message).encode() + b'\n')
+        with connection.makefile('rb') as file:
+            response = json.loads(file.readline())
+    if 'error' in response:
+        raise RenderError(response['error'])
+    if return_bytes:
+        return base64.b64decode(response['pdf'])
+    return response['path']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render an invoice with the invoice generator daemon.')
+    parser.add_argument('invoice', nargs='?', default='-',
+                        help='invoice JSON file, defaults to stdin')
+    parser.add_argument('--name', help='name of the pdf')
+    parser.add_argument('--socket', help='path of the daemon Unix socket')
+    parser.add_argument('--port', type=int,
+                        help='local TCP port of the daemon')
+    parser.add_argument('-o', '--output',
+                        help='write the pdf to this file instead of printing '
+                             'its path')
+    args = parser.parse_args(argv)
+    if args.invoice == '-':
+        invoice = sys.stdin.read()
+    else:
+        with open(args.invoice) as file:
+            invoice = file.read()
+    try:
+        result = request(invoice, args.name, bool(args.output),
+                         args.socket, args.port)
+    except RenderError as e:
+        sys.exit(f"error: {e}")
+    if args.output:
+        with open(args.output, 'wb') as file:
+            file.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Cache of rendered template blocks."""
+from collections import OrderedDict
+import hashlib
+import threading
+
+from jinja2 import nodes
+from pydantic import BaseModel
+
+from .models import Invoice
+from .preflight import (find_references, find_template_names,
+                        is_up_to_date, resolve_path, uptodate_checks)
+
+
+DEFAULT_BLOCKS = ('head', 'commercial_parties', 'payment', 'legal_notices')
+
+
+def _included_templates(node):
+    return [include.template.value for include in node.find_all(nodes.Include)
+            if isinstance(include.template, nodes.Const)]
+
+
+def _free_names(node, root='invoice'):
+    """Return the variables read by a node other than ``root``."""
+    stored = {name.name for name in node.find_all(nodes.Name)
+              if name.ctx in ('store', 'param')}
+    return {name.name for name in node.find_all(nodes.Name)
+            if name.ctx == 'load'} - stored - {root, 'loop'}
+
+
+def _chain_root(node):
+    while isinstance(node, nodes.Getattr):
+        node = node.node
+    return node
+
+
+def _is_name(node, name):
+    return isinstance(node, nodes.Name) and node.name == name
+
+
+def _reads_root_opaquely(node, root='invoice'):
+    """Tell whether a node reads ``root`` other than by attribute chains.
+
+    ``root`` used as a value, subscripted, assigned or aliased to another
+    variable can give access to any of its fields, which
+    :func:`~invoice_generator.preflight.find_references` doesn't see.
+    """
+    chained = {id(_chain_root(getattr_)) for getattr_ in
+               node.find_all(nodes.Getattr)}
+    for name in node.find_all(nodes.Name):
+        if name.name == root and (name.ctx != 'load'
+                                  or id(name) not in chained):
+            return True
+    for getitem in node.find_all(nodes.Getitem):
+        if _is_name(_chain_root(getitem.node), root):
+            return True
+    for assign in node.find_all((nodes.Assign, nodes.For, nodes.With)):
+        if isinstance(assign, nodes.Assign):
+            values = [assign.node]
+        elif isinstance(assign, nodes.For):
+            values = [assign.iter]
+        else:
+            values = assign.values
+        for value in values:
+            if any(_is_name(name, root) for name in
+                   [value, *value.find_all(nodes.Name)]):
+                return True
+    return False
+
+
+def _block_functions(template):
+    """Return the render function of each block of a template.
+
+    Blocks are looked up in the template and the templates it extends, the
+    most derived definition winning as when the template is rendered.
+    """
+    env = template.environment
+    functions = {}
+    while template is not None:
+        for name, render_func in template.blocks.items():
+            functions.setdefault(name, render_func)
+        ast = env.parse(env.loader.get_source(env, template.name)[0])
+        extends = ast.find(nodes.Extends)
+        if extends is not None and isinstance(extends.template, nodes.Const):
+            template = env.get_template(extends.template.value)
+        else:
+            template = None
+    return functions
+
+
+def block_references(env, template_name, model=Invoice, root='invoice'):
+    """Find the model fields read by each block of a template set.
+
+    Every definition of a block is taken into account, along with the
+    templates it includes and the blocks it contains, so the result is valid
+    whichever definition is used.
+
+    :param env: The jinja environment used to load the templates.
+    :type env: jinja2.Environment
+    :param template_name: The name of the entry point template.
+    :type template_name: str
+    :return: A dict mapping block names to the sorted attribute paths they
+        read, checked against the model (see
+        :func:`~invoice_generator.preflight.resolve_path`). Blocks which read
+        other variables than ``root``, or read ``root`` other than by
+        attribute chains, map to None.
+    :rtype: dict
+    """
+    asts = {name: env.parse(env.loader.get_source(env, name)[0])
+            for name in find_template_names(env, template_name)}
+    references, nested = {}, {}
+    for ast in asts.values():
+        for block in ast.find_all(nodes.Block):
+            paths = references.setdefault(block.name, set())
+            children = nested.setdefault(block.name, set())
+            parts = [block] + [asts[name] for name in
+                               _included_templates(block) if name in asts]
+            for part in parts:
+                if paths is not None and (_free_names(part, root) or
+                                          _reads_root_opaquely(part, root)):
+                    paths = references[block.name] = None
+                if paths is not None:
+                    paths.update(resolve_path(model, path)
+                                 for path in find_references(part, root))
+                children.update(child.name for child in
+                                part.find_all(nodes.Block))
+    result = {}
+    for name in references:
+        paths, to_visit, visited = set(), [name], set()
+        while to_visit:
+            block = to_visit.pop()
+            if block in visited:
+                continue
+            visited.add(block)
+            if references[block] is None:
+                paths = None
+                break
+            paths.update(references[block])
+            to_visit.extend(nested[block])
+        result[name] = sorted(paths) if paths is not None else None
+    return result
+
+
+def _resolve(obj, path):
+    for attr in path:
+        if obj is None:
+            return None
+        obj = getattr(obj, attr)
+    return obj
+
+
+def fingerprint(obj, paths):
+    """Hash the values read at the given paths of an object.
+
+    Models that are only read through their attributes are reduced to
+    whether they are set, their attributes being part of the paths.
+
+    :param obj: The object passed to the template.
+    :param paths: The attribute paths, see :func:`block_references`.
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        value = _resolve(obj, path)
+        is_prefix = any(other[:len(path)] == path and other != path
+                        for other in paths)
+        if isinstance(value, BaseModel):
+            value = '<set>' if is_prefix else value.json()
+        digest.update(repr((path, value)).encode())
+    return digest.hexdigest()
+
+
+class FragmentCache:
+    """Cache the rendered LaTeX of named template blocks.
+
+    A block is cached under the hash of the fields it actually reads, so
+    invoices from the same issuer share the blocks that only depend on the
+    issuer, like ``payment``, while the other blocks are rendered as usual.
+    When one of the templates changes, its blocks are analysed again and the
+    fragments rendered from the previous version are no longer used.
+
+    :param blocks: The names of the blocks to cache, defaults to
+        ``DEFAULT_BLOCKS``.
+    :type blocks: tuple, optional
+    :param maxsize: The maximum number of fragments kept, defaults to 1024.
+    :type maxsize: int, optional
+    """
+
+    def __init__(self, blocks=DEFAULT_BLOCKS, maxsize=1024):
+        self.blocks = blocks
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates = {}
+        self._generation = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+    def _block_references(self, template):
+        env = template.environment
+        key = (tuple(getattr(env.loader, 'searchpath', ())), template.name)
+        entry = self._templates.get(key)
+        if entry is None or not is_up_to_date(entry[3]):
+            references = block_references(env, template.name)
+            references = {name: paths for name, paths in references.items()
+                          if name in self.blocks and paths is not None}
+            checks = uptodate_checks(env,
+                                     find_template_names(env, template.name))
+            with self._lock:
+                self._generation += 1
+                entry = (key + (self._generation,), references,
+                         _block_functions(template), checks)
+            self._templates[key] = entry
+        return entry[:3]
+
+    def _cached_block(self, key, render_func):
+        def render(context):
+            with self._lock:
+                fragment = self._fragments.get(key)
+                if fragment is not None:
+                    self._fragments.move_to_end(key)
+                    self.hits += 1
+            if fragment is None:
+                fragment = ''.join(render_func(context))
+                with self._lock:
+                    self._fragments[key] = fragment
+                    if len(self._fragments) > self.maxsize:
+                        self._fragments.popitem(last=False)
+                    self.misses += 1
+            yield fragment
+        return render
+
+    def render(self, template, invoice):
+        """Render a template, reusing the cached blocks.
+
+        :param template: The template to render.
+        :type template: jinja2.Template
+        :param invoice: The invoice passed to the template.
+        :type invoice: Invoice
+        :return: The same text as ``template.render(invoice=invoice)``.
+        :rtype: str
+        """
+        template_key, references, functions = \
+            self._block_references(template)
+        context = template.new_context({'invoice': invoice})
+        for name, paths in references.items():
+            if name in functions:
+                key = (template_key, name, fingerprint(invoice, paths))
+                cached = self._cached_block(key, functions[name])
+                # Blocks of parent templates are appended to the context while
+                # rendering, the cached block stays first so it is used.
+                context.blocks[name] = [cached] + context.blocks.get(name,
+                                                                     [])[1:]
+        return ''.join(template.root_render_func(context))
@@ -1,4 +1,7 @@
 """Main module."""
+import glob
+import hashlib
+import json
 import os
 from pathlib import Path
 import re
@@ -7,6 +10,7 @@ import uuid
 import jinja2
 
 from .models import Invoice
+from .preflight import PreflightError, check_template
 
 
 JINJA_CONF = {
@@ -20,8 +24,69 @@ JINJA_CONF = {
     "line_comment_prefix": '%#',
     "trim_blocks": True,
     "autoescape": False,
+    "undefined": jinja2.StrictUndefined,
 }
 
+LATEX_OPTIONS = ["-synctex=1", "-interaction=nonstopmode"]
+
+ENGINES = {
+    "pdflatex": {"options": LATEX_OPTIONS,
+                 "output_option": "-output-directory",
+                 "runs": 2},
+    "lualatex": {"options": LATEX_OPTIONS,
+                 "output_option": "-output-directory",
+                 "runs": 2},
+    "xelatex": {"options": LATEX_OPTIONS,
+                "output_option": "-output-directory",
+                "runs": 2},
+    "tectonic": {"options": ["--keep-logs"],
+                 "output_option": "--outdir",
+                 "runs": 1},
+}
+
+DEFAULT_TEMPLATE_DIR = Path(__file__).resolve().parents[0] / 'templates'
+
+DEFAULT_ENGINE = "pdflatex"
+
+CALIBRATION_FILE = "engine.json"
+
+LAYOUTS = ("flat", "hash", "date")
+
+_ENVIRONMENTS = {}
+
+
+def latex_jinja_env(template_dir):
+    """Return the jinja environment of a template directory.
+
+    Environments are shared by every generator using the same directory, so
+    their templates are compiled once per process.
+
+    :param template_dir: The template directory.
+    :type template_dir: pathlib.Path
+    :rtype: jinja2.Environment
+    """
+    key = str(template_dir)
+    if key not in _ENVIRONMENTS:
+        loader = jinja2.FileSystemLoader(key)
+        _ENVIRONMENTS[key] = jinja2.Environment(loader=loader, **JINJA_CONF)
+    return _ENVIRONMENTS[key]
+
+
+def calibrated_engine(template_dir):
+    """Return the engine recorded by the calibration of a template directory.
+
+    :param template_dir: The template directory.
+    :type template_dir: pathlib.Path
+    :return: The name of the fastest engine, or None if the directory was
+        never calibrated.
+    :rtype: str
+    """
+    try:
+        with open(Path(template_dir) / CALIBRATION_FILE) as file:
+            return json.load(file)["engine"]
+    except FileNotFoundError:
+        return None
+
 
 class InvoiceGenerator:
     """Invoice Generator.
@@ -41,6 +106,24 @@ class InvoiceGenerator:
         no invoice_name are passed to generator, it will generate one using
         uuid4.
     :type invoice_name: str, optional
+    :param engine: The TeX engine, one of ``ENGINES``, defaults to None. If
+        no engine is passed to generator, it uses the engine recorded by the
+        calibration of the template directory, or pdflatex.
+    :type engine: str, optional
+    :param engine_options: Command line options of the engine, defaults to
+        the engine's options in ``ENGINES``.
+    :type engine_options: list, optional
+    :param fragment_cache: A cache of rendered blocks shared between
+        generators, defaults to None.
+    :type fragment_cache: FragmentCache, optional
+    :param layout: How pdfs are laid out in the output directory, one of
+        ``LAYOUTS``, defaults to ``flat``. ``hash`` shards them in two levels
+        of subdirectories named after the hash of the invoice name, ``date``
+        in year and month subdirectories of the emission date.
+    :type layout: str, optional
+    :param manifest: The manifest in which the generated pdf is recorded
+        under the invoice reference, defaults to None.
+    :type manifest: Manifest, optional
     """
 
     def __init__(self,
@@ -48,12 +131,23 @@ class InvoiceGenerator:
                  template_dir=None,
                  template_name=None,
                  output_directory=None,
-                 invoice_name=None):
+                 invoice_name=None,
+                 engine=None,
+                 engine_options=None,
+                 fragment_cache=None,
+                 layout=None,
+                 manifest=None):
         self.template_dir = template_dir
         self.template_name = template_name
         self.invoice_name = invoice_name
         self.output_directory = output_directory
+        self.engine = engine
+        self.engine_options = engine_options
+        self.fragment_cache = fragment_cache
+        self.layout = layout
+        self.manifest = manifest
         self.data = data
+        self._rendered = None
 
     @property
     def template_dir(self):
@@ -62,7 +156,7 @@ class InvoiceGenerator:
     @template_dir.setter
     def template_dir(self, template_dir):
         if not template_dir:
-            template_dir = Path(__file__).resolve().parents[0] / 'templates'
+            template_dir = DEFAULT_TEMPLATE_DIR
         if not os.path.exists(template_dir):
             msg = f"The directory {template_dir} doens't exists."
             raise FileNotFoundError(msg)
@@ -92,6 +186,45 @@ class InvoiceGenerator:
             template_name = "main.tex"
         self._template_name = template_name
 
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        engine = engine or calibrated_engine(self.template_dir) \
+            or DEFAULT_ENGINE
+        if engine not in ENGINES:
+            msg = f"Unknown engine {engine}, expected one of {list(ENGINES)}."
+            raise ValueError(msg)
+        self._engine = engine
+        if getattr(self, '_default_engine_options', False):
+            self.engine_options = None
+
+    @property
+    def engine_options(self):
+        return self._engine_options
+
+    @engine_options.setter
+    def engine_options(self, engine_options):
+        # Default options follow the engine when it is changed.
+        self._default_engine_options = engine_options is None
+        if engine_options is None:
+            engine_options = ENGINES[self.engine]["options"]
+        self._engine_options = list(engine_options)
+
+    @property
+    def layout(self):
+        return self._layout
+
+    @layout.setter
+    def layout(self, layout):
+        layout = layout or "flat"
+        if layout not in LAYOUTS:
+            msg = f"Unknown layout {layout}, expected one of {LAYOUTS}."
+            raise ValueError(msg)
+        self._layout = layout
+
     @property
     def invoice_name(self):
         return self._invoice_name
@@ -110,17 +243,28 @@ class InvoiceGenerator:
 
     @data.setter
     def data(self, data):
+        self._reference = data.reference
         data = self._escape_latex_characters(data.dict())
         self._data = Invoice(**data)
 
+    @property
+    def invoice_directory(self):
+        """The directory of the pdf, inside ``output_directory``."""
+        if self.layout == "hash":
+            digest = hashlib.sha1(self.invoice_name.encode()).hexdigest()
+            return self.output_directory / digest[:2] / digest[2:4]
+        if self.layout == "date":
+            emited = self.data.emited
+            return self.output_directory / f"{emited:%Y}" / f"{emited:%m}"
+        return self.output_directory
+
     @property
     def _file_to_compile(self):
-        return self.output_directory / (self.invoice_name)
+        return self.invoice_directory / (self.invoice_name)
 
     @property
     def _latex_jinja_env(self):
-        loader = jinja2.FileSystemLoader(self.template_dir)
-        return jinja2.Environment(loader=loader, **JINJA_CONF)
+        return latex_jinja_env(self.template_dir)
 
     @staticmethod
     def _tex_escape(text):
@@ -179,43 +323,75 @@ class InvoiceGenerator:
         self._template = self._latex_jinja_env\
                                 .get_template(self.template_name)
 
+    def _preflight(self):
+        """Validate the templates and render the invoice in memory.
+
+        Templates are checked once against the ``Invoice`` schema, then the
+        invoice is rendered with a strict undefined mode so any missing value
+        is reported before spending time in LaTeX.
+        """
+        env = self._template.environment
+        check_template(env, self.template_name)
+        try:
+            if self.fragment_cache is not None:
+                self._rendered = self.fragment_cache.render(self._template,
+                                                            self._data)
+            else:
+                self._rendered = self._template.render(invoice=self._data)
+        except jinja2.UndefinedError as e:
+            raise PreflightError(f"{self.template_name}: {e}") from e
+
     def _generate_tex(self):
-        to_compile = self._template.render(invoice=self._data)
+        if self._rendered is None:
+            self._preflight()
+        os.makedirs(self.invoice_directory, exist_ok=True)
         with open(str(self._file_to_compile) + '.tex', 'w') as file:
-            file.write(to_compile)
+            file.write(self._rendered)
+        self._rendered = None
 
     def _check_compilation_success(self):
-        if not re.search('Output written on', self.__stdout.decode()):
+        if self.engine == "tectonic":
+            success = self.__returncode == 0
+        else:
+            success = re.search('Output written on', self.__stdout.decode())
+        if not success:
             raise ValueError('Compilation failed')
 
     def _clean(self):
-        for dirname, _, filenames in os.walk(self.output_directory):
-            for f_name in filenames:
-                if f_name.startswith(self._invoice_name):
-                    if not f_name.endswith('.pdf'):
-                        os.remove(os.path.join(dirname, f_name))
+        pattern = glob.escape(str(self._file_to_compile)) + '.*'
+        for f_name in glob.glob(pattern):
+            if not f_name.endswith('.pdf'):
+                os.remove(f_name)
 
     def _compile_latex(self):
-        cmd = ['pdflatex',
-               "-synctex=1",
-               "-interaction=nonstopmode",
-               '-output-directory',
-               self.output_directory,
+        cmd = [self.engine,
+               *self.engine_options,
+               ENGINES[self.engine]["output_option"],
+               self.invoice_directory,
                self._file_to_compile
                ]
+        if self.engine == "tectonic":
+            cmd[-1] = str(self._file_to_compile) + '.tex'
+            cmd[1:1] = ['-Z', f'search-path={self.template_dir}']
         process = subprocess.Popen(cmd,
                                    cwd=self._template_dir,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
         self.__stdout, self.__stderr = process.communicate()
+        self.__returncode = process.returncode
         self._check_compilation_success()
 
         return self
 
     def run(self, clean=True):
         self._load_template()
+        self._preflight()
         self._generate_tex()
-        self._compile_latex()._compile_latex()
+        for _ in range(ENGINES[self.engine]["runs"]):
+            self._compile_latex()
         if clean:
             self._clean()
-        return self.output_directory / (self.invoice_name + '.pdf')
+        path = self.invoice_directory / (self.invoice_name + '.pdf')
+        if self.manifest is not None:
+            self.manifest.record(self._reference, path)
+        return path
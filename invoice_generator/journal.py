@@ -0,0 +1,175 @@
+"""Checkpoint journal for batch rendering."""
+import hashlib
+import os
+from pathlib import Path
+import socket
+import sqlite3
+import time
+
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    key TEXT PRIMARY KEY,
+    input_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    output TEXT,
+    worker TEXT,
+    updated REAL NOT NULL,
+    error TEXT
+)
+"""
+
+
+def _is_dead(worker):
+    """Tell whether a worker of this host has exited.
+
+    :param worker: A worker name, as ``hostname:pid``.
+    :type worker: str
+    :return: True if the worker ran on this host and its process is gone,
+        False if it is alive or can't be checked.
+    :rtype: bool
+    """
+    hostname, _, pid = (worker or '').rpartition(':')
+    if hostname != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+def input_hash(invoice, *extra):
+    """Hash an invoice and the rendering options it depends on.
+
+    :param invoice: The invoice to hash.
+    :type invoice: Invoice
+    :param extra: Other values that change the output, like the template
+        name.
+    :rtype: str
+    """
+    digest = hashlib.sha256(invoice.json(sort_keys=True).encode())
+    for value in extra:
+        digest.update(b'\0' + str(value).encode())
+    return digest.hexdigest()
+
+
+class Journal:
+    """Record the progress of a batch run in a SQLite database.
+
+    Each invoice is recorded with the hash of its input, its status and the
+    path of the generated pdf. Several worker processes of the same host can
+    share the same journal: an invoice is claimed by a single worker at a
+    time. The journal uses SQLite's WAL mode, which doesn't work on a network
+    filesystem, so each host needs its own journal file.
+
+    :param path: Path of the SQLite database, created if needed.
+    :type path: pathlib.Path or str
+    :param lease: Number of seconds after which an invoice claimed by a
+        worker that didn't report back is considered abandoned, defaults to
+        600. Invoices claimed by a worker whose process has exited are
+        abandoned right away.
+    :type lease: float, optional
+    :param worker: Name of the worker, defaults to ``hostname:pid``.
+    :type worker: str, optional
+    """
+
+    def __init__(self, path, lease=600, worker=None):
+        self.path = Path(path)
+        self.lease = lease
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        self._connection = sqlite3.connect(str(self.path),
+                                           timeout=60,
+                                           isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def _write(self, key, input_hash, status, output=None, error=None):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO journal '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, input_hash, status,
+             str(output) if output else None,
+             self.worker, time.time(), error)
+        )
+
+    def get(self, key):
+        """Return the journal entry of an invoice.
+
+        :return: A dict with the ``input_hash``, ``status``, ``output``,
+            ``worker``, ``updated`` and ``error`` of the invoice or None.
+        :rtype: dict
+        """
+        cursor = self._connection.execute(
+            'SELECT * FROM journal WHERE key = ?', (key,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def claim(self, key, input_hash):
+        """Claim an invoice before rendering it.
+
+        :param key: The invoice key, usually its reference.
+        :type key: str
+        :param input_hash: The hash of the invoice, see :func:`input_hash`.
+        :type input_hash: str
+        :return: False if the invoice was already rendered from the same input
+            and its output still exists, or if another worker is rendering
+            it and is still alive. True otherwise, the invoice is then marked
+            as running.
+        :rtype: bool
+        """
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            entry = self.get(key)
+            if entry and entry['input_hash'] == input_hash:
+                if entry['status'] == DONE \
+                        and os.path.exists(entry['output']):
+                    return False
+                if entry['status'] == RUNNING \
+                        and entry['worker'] != self.worker \
+                        and entry['updated'] > time.time() - self.lease \
+                        and not _is_dead(entry['worker']):
+                    return False
+            self._write(key, input_hash, RUNNING)
+            return True
+        finally:
+            self._connection.execute('COMMIT')
+
+    def complete(self, key, input_hash, output):
+        """Mark an invoice as rendered in ``output``."""
+        self._write(key, input_hash, DONE, output=output)
+
+    def fail(self, key, input_hash, error):
+        """Mark an invoice as failed with an ``error`` message."""
+        self._write(key, input_hash, FAILED, error=str(error))
+
+    def entries(self, status=None):
+        """List the journal entries, optionally filtered by status.
+
+        :rtype: list
+        """
+        query = 'SELECT * FROM journal'
+        params = ()
+        if status:
+            query += ' WHERE status = ?'
+            params = (status,)
+        cursor = self._connection.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
@@ -0,0 +1,101 @@
+"""Index of the pdf files of an output directory."""
+import hashlib
+import os
+from pathlib import Path
+import sqlite3
+
+
+MANIFEST_FILE = "manifest.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    reference TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT NOT NULL
+) WITHOUT ROWID
+"""
+
+
+def file_hash(path):
+    """Return the sha256 of a file.
+
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Map invoice references to their pdf in an output directory.
+
+    Paths are stored relative to the output directory, so the directory can
+    be moved or restored from a backup along with its manifest. Lookups go
+    through the primary key index and don't list any directory.
+
+    :param output_directory: The output directory.
+    :type output_directory: pathlib.Path or str
+    :param path: Path of the SQLite database, defaults to ``manifest.sqlite``
+        in the output directory.
+    :type path: pathlib.Path or str, optional
+    """
+
+    def __init__(self, output_directory, path=None):
+        self.output_directory = Path(output_directory)
+        self.path = Path(path or self.output_directory / MANIFEST_FILE)
+        os.makedirs(self.output_directory, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.path), timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM manifest').fetchone()[0]
+
+    def __contains__(self, reference):
+        return self.lookup(reference) is not None
+
+    def close(self):
+        self._connection.close()
+
+    def record(self, reference, path):
+        """Add or replace the pdf of an invoice.
+
+        :param reference: The invoice reference.
+        :type reference: str
+        :param path: The path of the pdf, inside the output directory.
+        :type path: pathlib.Path or str
+        """
+        path = Path(path)
+        relative = path.resolve().relative_to(self.output_directory.resolve())
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)',
+                (reference, relative.as_posix(), path.stat().st_size,
+                 file_hash(path)))
+
+    def lookup(self, reference):
+        """Return the pdf of an invoice.
+
+        :return: A dict with the absolute ``path``, the ``size`` and the
+            sha256 ``checksum`` of the pdf, or None if the reference is
+            unknown.
+        :rtype: dict
+        """
+        row = self._connection.execute(
+            'SELECT path, size, checksum FROM manifest WHERE reference = ?',
+            (reference,)).fetchone()
+        if row is None:
+            return None
+        return {"path": self.output_directory / row[0],
+                "size": row[1],
+                "checksum": row[2]}
@@ -49,6 +49,7 @@ class Issuer(BaseModel):
     company_name: str
     address: Optional[Address]
     siret: str
+    ape_code: Optional[str]
     intracom_vat: str
     logo: Optional[str]
     rib: Optional[RIB]
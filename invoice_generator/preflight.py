@@ -0,0 +1,153 @@
+"""Preflight validation of templates against the invoice schema."""
+from jinja2 import meta, nodes
+from pydantic.fields import SHAPE_SINGLETON
+
+from .models import Invoice
+
+
+_CHECKED_TEMPLATES = {}
+
+
+class PreflightError(ValueError):
+    """Raised when a template or an invoice can't be rendered."""
+
+
+def _attribute_chain(node):
+    """Return the attribute names accessed on a variable.
+
+    :param node: A ``Getattr`` node.
+    :return: The root variable name and the tuple of accessed attributes,
+        or ``(None, ())`` if the chain is not rooted on a plain variable.
+    """
+    attrs = []
+    while isinstance(node, nodes.Getattr):
+        attrs.append(node.attr)
+        node = node.node
+    if not isinstance(node, nodes.Name):
+        return None, ()
+    return node.name, tuple(reversed(attrs))
+
+
+def find_template_names(env, template_name):
+    """List a template and every template it extends or includes.
+
+    :param env: The jinja environment used to load the templates.
+    :type env: jinja2.Environment
+    :param template_name: The name of the entry point template.
+    :type template_name: str
+    :return: Template names, entry point first.
+    :rtype: list
+    """
+    names = []
+    to_visit = [template_name]
+    while to_visit:
+        name = to_visit.pop(0)
+        if name in names:
+            continue
+        names.append(name)
+        source = env.loader.get_source(env, name)[0]
+        ast = env.parse(source)
+        to_visit.extend(ref for ref in meta.find_referenced_templates(ast)
+                        if ref is not None)
+    return names
+
+
+def uptodate_checks(env, names):
+    """Return the up-to-date checks of templates, see :func:`is_up_to_date`.
+
+    :param env: The jinja environment used to load the templates.
+    :type env: jinja2.Environment
+    :param names: The template names, see :func:`find_template_names`.
+    :type names: list
+    :rtype: list
+    """
+    return [env.loader.get_source(env, name)[2] for name in names]
+
+
+def is_up_to_date(checks):
+    """Tell whether none of the templates changed since the checks were made.
+
+    :param checks: The result of :func:`uptodate_checks`.
+    :type checks: list
+    :rtype: bool
+    """
+    return all(check is None or check() for check in checks)
+
+
+def find_references(ast, root='invoice'):
+    """Collect the attribute paths read on ``root`` by a template AST.
+
+    Only plain attribute chains are collected: ``root`` used as a value,
+    subscripted or aliased to another variable is not reported.
+
+    :param ast: A parsed template or any jinja node.
+    :param root: The name of the variable to look for.
+    :type root: str
+    :return: The set of attribute paths, as tuples of names.
+    :rtype: set
+    """
+    references = set()
+    for node in ast.find_all(nodes.Getattr):
+        name, attrs = _attribute_chain(node)
+        if name == root:
+            references.add(attrs)
+    return references
+
+
+def resolve_path(model, path):
+    """Check an attribute path against a pydantic model.
+
+    The path is followed as long as it goes through nested models. Once it
+    reaches a value which is not a model (a date, a list, a property...),
+    the remaining attributes can't be checked statically and are ignored.
+
+    :param model: The pydantic model class the path starts from.
+    :param path: The attribute names.
+    :type path: tuple
+    :return: The part of the path that was checked against the schema.
+    :rtype: tuple
+    :raises PreflightError: if an attribute is not defined on the model.
+    """
+    for i, attr in enumerate(path):
+        field = model.__fields__.get(attr)
+        if field is None:
+            if not hasattr(model, attr):
+                msg = (f"{model.__name__} has no attribute '{attr}' "
+                       f"(referenced as {'.'.join(path[:i + 1])}).")
+                raise PreflightError(msg)
+            return path[:i + 1]
+        if field.shape != SHAPE_SINGLETON \
+                or not hasattr(field.type_, '__fields__'):
+            return path[:i + 1]
+        model = field.type_
+    return path
+
+
+def check_template(env, template_name, model=Invoice, root='invoice'):
+    """Statically check a template set against a model.
+
+    The result is cached per environment loader search path and template
+    name, so the templates are only parsed again when one of them changes.
+
+    :param env: The jinja environment used to load the templates.
+    :type env: jinja2.Environment
+    :param template_name: The name of the entry point template.
+    :type template_name: str
+    :param model: The pydantic model passed to the template.
+    :param root: The name under which the model is passed to the template.
+    :type root: str
+    :raises PreflightError: if a template references an unknown attribute.
+    """
+    key = (tuple(getattr(env.loader, 'searchpath', ())), template_name,
+           model, root)
+    if key in _CHECKED_TEMPLATES and is_up_to_date(_CHECKED_TEMPLATES[key]):
+        return
+    names = find_template_names(env, template_name)
+    for name in names:
+        source = env.loader.get_source(env, name)[0]
+        for path in sorted(find_references(env.parse(source), root)):
+            try:
+                resolve_path(model, path)
+            except PreflightError as e:
+                raise PreflightError(f"{name}: {e}") from None
+    _CHECKED_TEMPLATES[key] = uptodate_checks(env, names)
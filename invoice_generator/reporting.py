@@ -0,0 +1,263 @@
+"""VAT and revenue reporting across many invoices."""
+from array import array
+import csv
+from decimal import Decimal, ROUND_HALF_UP
+import json
+
+from .invoice_generator import InvoiceGenerator
+from .models import Invoice
+
+
+GROUP_KEYS = ('month', 'customer', 'rate')
+
+CENT = Decimal('0.01')
+
+
+def to_decimal(value):
+    """Convert an amount to a ``Decimal``.
+
+    Floats are converted from their shortest decimal representation, so
+    ``0.285`` stays ``0.285`` and not ``0.28499999999999998``.
+    """
+    return Decimal(repr(value) if isinstance(value, float) else value)
+
+
+def to_cents(value):
+    """Convert an amount to an integer number of cents, rounded half up.
+
+    :param value: The amount.
+    :type value: float or int or str or decimal.Decimal
+    :rtype: int
+    """
+    amount = to_decimal(value)
+    return int(amount.quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+
+
+def from_cents(cents):
+    """Convert a number of cents to a ``Decimal`` amount."""
+    return Decimal(cents).scaleb(-2)
+
+
+def customer_key(customer):
+    """Return the label used to group invoices by customer.
+
+    :param customer: A customer, either a model or its ``dict()``.
+    :type customer: Customer or dict
+    :rtype: str
+    """
+    if not isinstance(customer, dict):
+        customer = customer.dict()
+    if customer.get('name'):
+        return customer['name']
+    names = [customer.get('first_name'), customer.get('last_name')]
+    return ' '.join(name for name in names if name) \
+        or customer.get('email') or ''
+
+
+def iter_json_invoices(file):
+    """Stream invoices from a JSON export.
+
+    The export contains one invoice per line, as produced by
+    ``Invoice.json()``. The invoices are not validated by pydantic, the
+    report only reads the fields it needs.
+
+    :param file: An open text file.
+    :return: An iterator of invoices as dicts.
+    """
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+class VatReport:
+    """Totals by VAT rate across many invoices.
+
+    Each invoice is stored as one row per VAT rate, in columnar arrays: the
+    emission month, the customer, the VAT rate and the amounts, which are
+    kept as integer cents so totals are exact.
+
+    The net and VAT amounts of a rate are computed exactly from the line
+    items, as decimals, and rounded half up once per invoice. The invoice
+    itself rounds its float totals with ``round``, so an amount ending with
+    a half cent may differ by one cent from the report.
+    """
+
+    def __init__(self):
+        self.months = array('l')
+        self.customers = array('l')
+        self.rates = array('l')
+        self.net = array('q')
+        self.vat = array('q')
+        self._customer_labels = []
+        self._customer_index = {}
+
+    def __len__(self):
+        return len(self.net)
+
+    @classmethod
+    def from_invoices(cls, invoices):
+        """Build a report from an iterable of invoices.
+
+        :param invoices: Invoices, either models or dicts as found in a JSON
+            export.
+        :rtype: VatReport
+        """
+        report = cls()
+        report.extend(invoices)
+        return report
+
+    @classmethod
+    def from_json(cls, *paths):
+        """Build a report from JSON export files.
+
+        :param paths: Paths of files containing one invoice per line.
+        :rtype: VatReport
+        """
+        report = cls()
+        for path in paths:
+            with open(path) as file:
+                report.extend(iter_json_invoices(file))
+        return report
+
+    def extend(self, invoices):
+        for invoice in invoices:
+            self.add(invoice)
+
+    def _customer_id(self, label):
+        try:
+            return self._customer_index[label]
+        except KeyError:
+            self._customer_index[label] = len(self._customer_labels)
+            self._customer_labels.append(label)
+            return self._customer_index[label]
+
+    def add(self, invoice):
+        """Append the amounts of an invoice to the report.
+
+        :param invoice: An invoice, either a model or a dict as found in a
+            JSON export.
+        :type invoice: Invoice or dict
+        """
+        if isinstance(invoice, Invoice):
+            emited = invoice.emited
+            month = emited.year * 100 + emited.month
+            customer = self._customer_id(customer_key(invoice.customer))
+            lines = [(p.unit_price, p.quantity, p.vat)
+                     for p in invoice.prestations]
+        else:
+            month = int(invoice['emited'][:7].replace('-', ''))
+            customer = self._customer_id(customer_key(invoice['customer']))
+            lines = [(p['unit_price'], p['quantity'], p.get('vat', 0.0))
+                     for p in invoice['prestations']]
+        net_by_rate = {}
+        for unit_price, quantity, vat in lines:
+            net = to_decimal(unit_price) * to_decimal(quantity)
+            net_by_rate[vat] = net_by_rate.get(vat, 0) + net
+        for vat, net in net_by_rate.items():
+            rate = to_decimal(vat)
+            self.months.append(month)
+            self.customers.append(customer)
+            self.rates.append(to_cents(rate))
+            self.net.append(to_cents(net))
+            self.vat.append(to_cents(net * rate / 100))
+
+    def _column(self, key):
+        if key == 'month':
+            return self.months
+        if key == 'customer':
+            return self.customers
+        if key == 'rate':
+            return self.rates
+        msg = f"Can't group by {key}, expected one of {GROUP_KEYS}."
+        raise ValueError(msg)
+
+    def _label(self, key, value):
+        if key == 'month':
+            return f"{value // 100:04d}-{value % 100:02d}"
+        if key == 'customer':
+            return self._customer_labels[value]
+        return from_cents(value)
+
+    def totals(self, by=('month', 'rate')):
+        """Compute the totals grouped by some keys.
+
+        :param by: The keys to group by, among ``month``, ``customer`` and
+            ``rate``.
+        :type by: tuple
+        :return: One dict per group, sorted by keys, with the group keys and
+            the ``net``, ``vat`` and ``total`` amounts as ``Decimal``.
+        :rtype: list
+        """
+        columns = [self._column(key) for key in by]
+        groups = {}
+        for key, net, vat in zip(zip(*columns), self.net, self.vat):
+            try:
+                total = groups[key]
+            except KeyError:
+                total = groups[key] = [0, 0]
+            total[0] += net
+            total[1] += vat
+        rows = []
+        for key in sorted(groups):
+            net, vat = groups[key]
+            row = {name: self._label(name, value)
+                   for name, value in zip(by, key)}
+            row.update(net=from_cents(net),
+                       vat=from_cents(vat),
+                       total=from_cents(net + vat))
+            rows.append(row)
+        return rows
+
+    def to_csv(self, file, by=('month', 'rate')):
+        """Write the grouped totals as CSV.
+
+        :param file: An open text file.
+        :param by: The keys to group by, see :meth:`totals`.
+        """
+        writer = csv.DictWriter(file, fieldnames=list(by) + ['net', 'vat',
+                                                             'total'])
+        writer.writeheader()
+        writer.writerows(self.totals(by))
+
+
+class VatReportGenerator(InvoiceGenerator):
+    """Generate a summary of a VAT report in pdf using LaTeX.
+
+    :param data: The report to render.
+    :type data: VatReport
+    :param by: The keys to group the totals by, see :meth:`VatReport.totals`.
+    :type by: tuple, optional
+
+    Other parameters are the same as :class:`InvoiceGenerator`, the default
+    template is ``vat_report.tex``.
+    """
+
+    def __init__(self, data, *args, by=('month', 'rate'), **kwargs):
+        self.by = by
+        super().__init__(data, *args, **kwargs)
+
+    @property
+    def template_name(self):
+        return self._template_name
+
+    @template_name.setter
+    def template_name(self, template_name):
+        self._template_name = template_name or "vat_report.tex"
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        rows = [{key: str(value) for key, value in row.items()}
+                for row in data.totals(self.by)]
+        self._escape_latex_characters(rows)
+        self._rows = rows
+
+    def _preflight(self):
+        self._rendered = self._template.render(report=self._data,
+                                               by=self.by,
+                                               rows=self._rows)
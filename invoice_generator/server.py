@@ -0,0 +1,189 @@
+"""Resident render daemon."""
+import argparse
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import socketserver
+import threading
+import weakref
+
+from .batch import invoice_name as default_invoice_name, safe_name
+from .client import DEFAULT_SOCKET
+from .fragments import FragmentCache
+from .invoice_generator import (DEFAULT_TEMPLATE_DIR, InvoiceGenerator,
+                                latex_jinja_env)
+from .models import Invoice
+from .preflight import check_template
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.daemon.render(request)
+        except Exception as e:
+            response = {"error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class InvoiceDaemon:
+    """Render invoices sent by :mod:`invoice_generator.client`.
+
+    The templates are loaded and checked once at startup and the rendered
+    blocks are cached between invoices (see
+    :class:`~invoice_generator.fragments.FragmentCache`), so each request
+    only costs the LaTeX compilation. Requests for the same invoice name are
+    compiled one after the other, as they share their files.
+
+    :param output_directory: Path of output directory
+    :type output_directory: pathlib.Path or str
+    :param template_dir: See :class:`InvoiceGenerator`.
+    :param template_name: See :class:`InvoiceGenerator`.
+    :param workers: Number of invoices compiled at the same time, defaults
+        to the number of CPUs.
+    :type workers: int, optional
+    :param options: Other options of :class:`InvoiceGenerator`, like the
+        ``engine`` or the ``layout``.
+    """
+
+    def __init__(self, output_directory, template_dir=None,
+                 template_name=None, workers=None, **options):
+        self.output_directory = output_directory
+        template_dir = template_dir or DEFAULT_TEMPLATE_DIR
+        self.template_dir = Path(template_dir).resolve()
+        self.template_name = template_name or 'main.tex'
+        self.options = options
+        self.fragment_cache = FragmentCache()
+        self._pool = ThreadPoolExecutor(workers or os.cpu_count())
+        self._server = None
+        self._names_lock = threading.Lock()
+        self._name_locks = weakref.WeakValueDictionary()
+        self._preload()
+
+    def _preload(self):
+        env = latex_jinja_env(self.template_dir)
+        env.get_template(self.template_name)
+        check_template(env, self.template_name)
+
+    def _name_lock(self, invoice_name):
+        with self._names_lock:
+            lock = self._name_locks.get(invoice_name)
+            if lock is None:
+                lock = self._name_locks[invoice_name] = threading.Lock()
+            return lock
+
+    def _render(self, invoice, invoice_name, read=False):
+        with self._name_lock(invoice_name):
+            path = self._run(invoice, invoice_name)
+            if not read:
+                return path, None
+            # Read before releasing the lock, another request for the same
+            # name would overwrite the pdf.
+            with open(path, 'rb') as file:
+                return path, file.read()
+
+    def _run(self, invoice, invoice_name):
+        generator = InvoiceGenerator(invoice,
+                                     template_dir=self.template_dir,
+                                     template_name=self.template_name,
+                                     output_directory=self.output_directory,
+                                     invoice_name=invoice_name,
+                                     fragment_cache=self.fragment_cache,
+                                     **self.options)
+        return generator.run()
+
+    def render(self, request):
+        """Render the invoice of a request.
+
+        :param request: A dict with the ``invoice`` as a dict, an optional
+            ``invoice_name`` and ``return`` set to ``path`` or ``bytes``. The
+            invoice name is sanitized with
+            :func:`~invoice_generator.batch.safe_name`.
+        :type request: dict
+        :return: A dict with the ``path`` of the pdf and, when requested, its
+            base64 encoded content as ``pdf``.
+        :rtype: dict
+        """
+        invoice = Invoice.parse_obj(request['invoice'])
+        if request.get('invoice_name'):
+            name = safe_name(request['invoice_name'])
+        else:
+            name = default_invoice_name(invoice)
+        read = request.get('return') == 'bytes'
+        path, pdf = self._pool.submit(self._render, invoice, name,
+                                      read).result()
+        response = {"path": str(path)}
+        if read:
+            response["pdf"] = base64.b64encode(pdf).decode()
+        return response
+
+    def serve_forever(self, socket_path=None, port=None):
+        """Listen on a Unix socket, or on a local TCP port.
+
+        :param socket_path: Path of the Unix socket, defaults to
+            ``DEFAULT_SOCKET``.
+        :type socket_path: str, optional
+        :param port: Local TCP port, used instead of the Unix socket.
+        :type port: int, optional
+        """
+        if port is not None:
+            self._server = _TCPServer(('127.0.0.1', port), _Handler)
+        else:
+            socket_path = socket_path or DEFAULT_SOCKET
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._server = _UnixServer(socket_path, _Handler)
+        self._server.daemon = self
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if port is None:
+                os.remove(socket_path)
+
+    def shutdown(self):
+        """Stop serving, from another thread."""
+        if self._server is not None:
+            self._server.shutdown()
+        self._pool.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the invoice generator '
+                                                 'render daemon.')
+    parser.add_argument('output_directory')
+    parser.add_argument('--template-dir', default=None)
+    parser.add_argument('--template-name', default=None)
+    parser.add_argument('--engine', default=None)
+    parser.add_argument('--layout', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--socket', help='path of the Unix socket')
+    parser.add_argument('--port', type=int,
+                        help='listen on this local TCP port instead')
+    args = parser.parse_args(argv)
+    daemon = InvoiceDaemon(args.output_directory,
+                           template_dir=args.template_dir,
+                           template_name=args.template_name,
+                           workers=args.workers,
+                           engine=args.engine,
+                           layout=args.layout)
+    try:
+        daemon.serve_forever(args.socket, args.port)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
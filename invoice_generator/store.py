@@ -0,0 +1,199 @@
+"""Embedded store of invoices."""
+from pathlib import Path
+import sqlite3
+import zlib
+
+from .batch import render_batch
+from .manifest import file_hash
+from .models import Invoice
+from .reporting import customer_key
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    reference TEXT PRIMARY KEY,
+    emited TEXT NOT NULL,
+    customer TEXT NOT NULL,
+    issuer TEXT NOT NULL,
+    data BLOB NOT NULL,
+    pdf_path TEXT,
+    pdf_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS invoices_emited ON invoices (emited);
+CREATE INDEX IF NOT EXISTS invoices_customer ON invoices (customer, emited);
+CREATE INDEX IF NOT EXISTS invoices_issuer ON invoices (issuer, emited);
+"""
+
+
+class InvoiceStore:
+    """Store invoices in a SQLite database.
+
+    Invoices are kept as compressed JSON and indexed by reference, emission
+    date, customer (see :func:`~invoice_generator.reporting.customer_key`)
+    and issuer SIRET, along with the path and hash of their pdf.
+
+    :param path: Path of the SQLite database, created if needed.
+    :type path: pathlib.Path or str
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._connection = sqlite3.connect(str(self.path))
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM invoices').fetchone()[0]
+
+    def __contains__(self, reference):
+        return self._connection.execute(
+            'SELECT 1 FROM invoices WHERE reference = ?',
+            (reference,)).fetchone() is not None
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _row(invoice):
+        return (invoice.reference,
+                invoice.emited.isoformat(),
+                customer_key(invoice.customer),
+                invoice.issuer.siret,
+                zlib.compress(invoice.json().encode()))
+
+    def add(self, invoice):
+        """Add or replace an invoice."""
+        self.add_many([invoice])
+
+    def add_many(self, invoices):
+        """Add or replace invoices in a single transaction.
+
+        :param invoices: The invoices to add.
+        :type invoices: iterable of Invoice
+        """
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO invoices '
+                '(reference, emited, customer, issuer, data) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (self._row(invoice) for invoice in invoices))
+
+    def get(self, reference):
+        """Return the invoice with this reference.
+
+        :rtype: Invoice
+        :raises KeyError: if there is no such invoice.
+        """
+        row = self._connection.execute(
+            'SELECT data FROM invoices WHERE reference = ?',
+            (reference,)).fetchone()
+        if row is None:
+            raise KeyError(reference)
+        return Invoice.parse_raw(zlib.decompress(row[0]))
+
+    def _select(self, columns, customer=None, issuer=None,
+                emited_from=None, emited_to=None):
+        conditions, params = [], []
+        if customer is not None:
+            conditions.append('customer = ?')
+            params.append(customer)
+        if issuer is not None:
+            conditions.append('issuer = ?')
+            params.append(issuer)
+        if emited_from is not None:
+            conditions.append('emited >= ?')
+            params.append(emited_from.isoformat())
+        if emited_to is not None:
+            conditions.append('emited <= ?')
+            params.append(emited_to.isoformat())
+        query = f'SELECT {columns} FROM invoices'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return self._connection.execute(query + ' ORDER BY emited, reference',
+                                        params)
+
+    def query(self, customer=None, issuer=None, emited_from=None,
+              emited_to=None):
+        """Find invoices, ordered by emission date.
+
+        :param customer: The customer name, see
+            :func:`~invoice_generator.reporting.customer_key`.
+        :type customer: str, optional
+        :param issuer: The issuer SIRET.
+        :type issuer: str, optional
+        :param emited_from: The first emission date, included.
+        :type emited_from: datetime.date, optional
+        :param emited_to: The last emission date, included.
+        :type emited_to: datetime.date, optional
+        :return: An iterator of invoices.
+        """
+        cursor = self._select('data', customer, issuer, emited_from,
+                              emited_to)
+        for row in cursor:
+            yield Invoice.parse_raw(zlib.decompress(row[0]))
+
+    def references(self, **filters):
+        """List the references of the invoices matching ``filters``.
+
+        :param filters: See :meth:`query`.
+        :rtype: list
+        """
+        return [row[0] for row in self._select('reference', **filters)]
+
+    def set_rendered(self, rendered):
+        """Record the pdf of rendered invoices.
+
+        :param rendered: A dict mapping references to pdf paths.
+        :type rendered: dict
+        """
+        with self._connection:
+            self._connection.executemany(
+                'UPDATE invoices SET pdf_path = ?, pdf_hash = ? '
+                'WHERE reference = ?',
+                [(str(path), file_hash(path), reference)
+                 for reference, path in rendered.items()])
+
+    def rendered(self, reference):
+        """Return the pdf path and hash of an invoice.
+
+        :return: The path and the sha256 of the pdf, or None if the invoice
+            was not rendered.
+        :rtype: tuple
+        """
+        row = self._connection.execute(
+            'SELECT pdf_path, pdf_hash FROM invoices WHERE reference = ?',
+            (reference,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return Path(row[0]), row[1]
+
+    def render(self, output_directory, customer=None, issuer=None,
+               emited_from=None, emited_to=None, **options):
+        """Render the invoices matching the filters and record their pdf.
+
+        The invoices are streamed from the database to
+        :func:`~invoice_generator.batch.render_batch`.
+
+        :param output_directory: Path of output directory
+        :type output_directory: pathlib.Path or str
+        :param customer: See :meth:`query`.
+        :param issuer: See :meth:`query`.
+        :param emited_from: See :meth:`query`.
+        :param emited_to: See :meth:`query`.
+        :param options: Other options of
+            :func:`~invoice_generator.batch.render_batch`, like the
+            ``journal``, the ``template_dir`` or the ``layout``.
+        :return: See :func:`~invoice_generator.batch.render_batch`.
+        :rtype: tuple
+        """
+        invoices = self.query(customer, issuer, emited_from, emited_to)
+        rendered, failed, skipped = render_batch(invoices, output_directory,
+                                                 **options)
+        self.set_rendered(rendered)
+        return rendered, failed, skipped
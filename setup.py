@@ -31,6 +31,13 @@ setup(
         'Programming Language :: Python :: 3.8',
     ],
     description="generate french invoices with latex from python",
+    entry_points={
+        'console_scripts': [
+            'invoice-generator-calibrate=invoice_generator.calibration:main',
+            'invoice-generator-daemon=invoice_generator.server:main',
+            'invoice-generator-client=invoice_generator.client:main',
+        ],
+    },
     install_requires=requirements,
     license="Apache Software License 2.0",
     long_description=readme + '\n\n' + history,
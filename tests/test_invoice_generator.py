@@ -1,12 +1,27 @@
 #!/usr/bin/env python
 
 """Tests for `invoice_generator` package."""
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from decimal import Decimal
+import io
+import json
 import os
 from pathlib import Path
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
 import pytest
 from jinja2 import Template
-from invoice_generator import invoice_generator, models
+from invoice_generator import (invoice_generator, models, preflight,
+                               reporting, batch, calibration, fragments)
+from invoice_generator import journal as journal_module
+from invoice_generator import store as store_module
+from invoice_generator import manifest as manifest_module
+from invoice_generator import client, server
 
 
 @pytest.fixture
@@ -192,3 +207,541 @@ def test_invoice_generator_clean(generator, tmpdir):
 def test_invoice_generator_compilation_failed(generator):
     with pytest.raises(ValueError):
         generator._compile_latex()
+
+
+def test_invoice_generator_preflight(generator):
+    generator._load_template()
+    generator._preflight()
+    assert r"characters\_to\_escape" in generator._rendered
+
+
+def test_preflight_find_template_names(generator):
+    generator._load_template()
+    names = preflight.find_template_names(generator._template.environment,
+                                          'main.tex')
+    assert names[:2] == ['main.tex', 'base.tex']
+    assert 'payment.tex' in names
+
+
+def test_preflight_resolve_path():
+    path = ('issuer', 'rib', 'iban')
+    assert preflight.resolve_path(models.Invoice, path) == path
+    path = ('emited', 'strftime')
+    assert preflight.resolve_path(models.Invoice, path) == ('emited',)
+    path = ('total_by_vat', 'keys')
+    assert preflight.resolve_path(models.Invoice, path) == ('total_by_vat',)
+
+
+def test_preflight_unknown_attribute():
+    with pytest.raises(preflight.PreflightError):
+        preflight.resolve_path(models.Invoice, ('late_payment_terms',))
+    with pytest.raises(preflight.PreflightError):
+        preflight.resolve_path(models.Invoice, ('issuer', 'rib', 'swift'))
+
+
+def test_preflight_bad_template(generator, tmpdir):
+    with open(tmpdir / 'bad.tex', 'w') as f:
+        f.write(r"\VAR{invoice.issuer.unknown_field}")
+    generator.template_dir = str(tmpdir)
+    generator.template_name = 'bad.tex'
+    generator._load_template()
+    with pytest.raises(preflight.PreflightError):
+        generator._preflight()
+
+
+def test_reporting_to_cents():
+    assert reporting.to_cents(0.285) == 29
+    assert reporting.to_cents(20) == 2000
+    assert reporting.from_cents(1230) == Decimal('12.30')
+
+
+def test_reporting_totals(invoice):
+    second = invoice.copy(deep=True)
+    second.prestations = [models.Prestation(title="other",
+                                            unit_price=10.005,
+                                            quantity=1,
+                                            vat=20)]
+    report = reporting.VatReport.from_invoices([invoice, second])
+    assert len(report) == 2
+    rows = report.totals(by=('rate',))
+    assert [row['rate'] for row in rows] == [Decimal('10.00'),
+                                             Decimal('20.00')]
+    assert [row['vat'] for row in rows] == [Decimal('2.00'),
+                                            Decimal('2.00')]
+    assert [row['net'] for row in rows] == [Decimal('20.00'),
+                                            Decimal('10.01')]
+    month = invoice.emited.strftime('%Y-%m')
+    assert report.totals(by=('month',))[0]['total'] == Decimal('34.01')
+    assert report.totals(by=('month',))[0]['month'] == month
+
+
+def test_reporting_vat_rounded_per_invoice(invoice):
+    invoice.prestations = [models.Prestation(title="small",
+                                             unit_price=0.05,
+                                             quantity=1,
+                                             vat=5.5)] * 10
+    report = reporting.VatReport.from_invoices([invoice])
+    assert len(report) == 1
+    row, = report.totals(by=('rate',))
+    assert row['net'] == Decimal('0.50')
+    assert row['vat'] == Decimal('0.03')
+
+
+def test_reporting_exact_line_totals(invoice):
+    # 0.145 * 3 is 0.43499999999999994 as a float
+    invoice.prestations = [models.Prestation(title="exact",
+                                             unit_price=0.145,
+                                             quantity=3,
+                                             vat=20)]
+    row, = reporting.VatReport.from_invoices([invoice]).totals(by=('rate',))
+    assert row['net'] == Decimal('0.44')
+    assert row['vat'] == Decimal('0.09')
+
+
+def test_reporting_from_json(invoice, tmpdir):
+    with open(tmpdir / 'export.json', 'w') as f:
+        f.write(invoice.json() + '\n' + invoice.json() + '\n')
+    report = reporting.VatReport.from_json(tmpdir / 'export.json')
+    rows = report.totals(by=('customer', 'rate'))
+    assert rows == [{'customer': "Dupond's company",
+                     'rate': Decimal('10.00'),
+                     'net': Decimal('40.00'),
+                     'vat': Decimal('4.00'),
+                     'total': Decimal('44.00')}]
+
+
+def test_reporting_to_csv(invoice):
+    output = io.StringIO()
+    reporting.VatReport.from_invoices([invoice]).to_csv(output, by=('rate',))
+    assert output.getvalue().splitlines() == ['rate,net,vat,total',
+                                              '10.00,20.00,2.00,22.00']
+
+
+def test_reporting_generator(invoice, template_dir, tmpdir):
+    report = reporting.VatReport.from_invoices([invoice])
+    generator = reporting.VatReportGenerator(report,
+                                             template_dir,
+                                             output_directory=tmpdir,
+                                             invoice_name='report')
+    generator._load_template()
+    generator._preflight()
+    assert "22.00" in generator._rendered
+
+
+@pytest.fixture
+def journal(tmpdir):
+    with journal_module.Journal(tmpdir / 'journal.sqlite') as journal:
+        yield journal
+
+
+@pytest.fixture
+def fake_run(monkeypatch):
+    def compile_latex(self):
+        if self.data.reference == 'broken':
+            raise ValueError('Compilation failed')
+        with open(str(self._file_to_compile) + '.pdf', 'w') as f:
+            f.write(self.data.reference)
+        return self
+    monkeypatch.setattr(invoice_generator.InvoiceGenerator, '_compile_latex',
+                        compile_latex)
+
+
+def test_journal_claim(journal, tmpdir):
+    assert journal.claim('2021-001', 'hash')
+    other = journal_module.Journal(journal.path, worker='other')
+    assert not other.claim('2021-001', 'hash')
+    journal.complete('2021-001', 'hash', tmpdir / 'journal.sqlite')
+    assert not other.claim('2021-001', 'hash')
+    assert other.claim('2021-001', 'changed')
+    assert journal.get('2021-001')['worker'] == 'other'
+
+
+def test_journal_claim_missing_output(journal, tmpdir):
+    journal.claim('2021-001', 'hash')
+    journal.complete('2021-001', 'hash', tmpdir / 'missing.pdf')
+    assert journal.claim('2021-001', 'hash')
+
+
+def test_journal_input_hash(invoice):
+    digest = journal_module.input_hash(invoice, 'main.tex')
+    assert digest == journal_module.input_hash(invoice.copy(), 'main.tex')
+    assert digest != journal_module.input_hash(invoice, 'other.tex')
+
+
+@pytest.fixture
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_render_batch_resume_after_crash(invoice, journal, fake_run, tmpdir,
+                                         dead_pid):
+    crashed = journal_module.Journal(journal.path,
+                                     worker=f"{socket.gethostname()}:"
+                                            f"{dead_pid}")
+    digest = journal_module.input_hash(invoice, None, None, None)
+    assert crashed.claim('2021-001', digest)
+    rendered, failed, skipped = batch.render_batch([invoice], tmpdir,
+                                                   journal=journal)
+    assert list(rendered) == ['2021-001']
+    assert failed == skipped == {}
+
+
+def test_render_batch_skips_live_worker(invoice, journal, fake_run, tmpdir):
+    other = journal_module.Journal(journal.path, worker='other-host:1')
+    digest = journal_module.input_hash(invoice, None, None, None)
+    assert other.claim('2021-001', digest)
+    rendered, failed, skipped = batch.render_batch([invoice], tmpdir,
+                                                   journal=journal)
+    assert rendered == failed == {}
+    assert skipped == {'2021-001': 'other-host:1'}
+
+
+def test_render_batch_resume(invoice, journal, fake_run, tmpdir):
+    broken = invoice.copy(update={'reference': 'broken'})
+    invoices = [invoice, broken]
+    rendered, failed, _ = batch.render_batch(invoices, tmpdir,
+                                             journal=journal)
+    assert rendered == {'2021-001': tmpdir / '2021-001.pdf'}
+    assert list(failed) == ['broken']
+    assert journal.get('broken')['status'] == journal_module.FAILED
+    with open(tmpdir / '2021-001.pdf', 'w') as f:
+        f.write('not rendered again')
+    rendered, failed, _ = batch.render_batch(invoices, tmpdir,
+                                             journal=journal)
+    assert str(rendered['2021-001']) == str(tmpdir / '2021-001.pdf')
+    with open(tmpdir / '2021-001.pdf') as f:
+        assert f.read() == 'not rendered again'
+    assert list(failed) == ['broken']
+
+
+def test_invoice_generator_engine_default(generator):
+    assert generator.engine == 'pdflatex'
+    assert generator.engine_options == invoice_generator.LATEX_OPTIONS
+
+
+def test_invoice_generator_bad_engine(generator):
+    with pytest.raises(ValueError):
+        generator.engine = 'word'
+
+
+def test_invoice_generator_calibrated_engine(invoice, tmpdir):
+    with open(tmpdir / invoice_generator.CALIBRATION_FILE, 'w') as f:
+        json.dump({'engine': 'xelatex', 'timings': {'xelatex': 1.0}}, f)
+    generator = invoice_generator.InvoiceGenerator(invoice, str(tmpdir))
+    assert generator.engine == 'xelatex'
+    generator = invoice_generator.InvoiceGenerator(invoice, str(tmpdir),
+                                                   engine='lualatex',
+                                                   engine_options=[])
+    assert generator.engine == 'lualatex'
+    assert generator.engine_options == []
+    generator.engine = 'xelatex'
+    assert generator.engine_options == []
+
+
+def test_invoice_generator_engine_changed(generator):
+    generator.engine = 'tectonic'
+    assert generator.engine_options == \
+        invoice_generator.ENGINES['tectonic']['options']
+
+
+def test_calibration_engine_not_installed(edited_template_dir, monkeypatch):
+    monkeypatch.setenv('PATH', '')
+    with pytest.warns(UserWarning, match='tectonic'):
+        with pytest.raises(RuntimeError, match='No engine'):
+            calibration.calibrate(edited_template_dir, engines=['tectonic'],
+                                  sizes=(1,))
+
+
+def test_calibration_example_invoice():
+    invoice = calibration.example_invoice(26)
+    assert len(invoice.paginated_prestations) == 2
+    assert invoice == calibration.example_invoice(26)
+
+
+def test_fragment_block_references(generator):
+    generator._load_template()
+    references = fragments.block_references(generator._template.environment,
+                                            'main.tex')
+    assert ('issuer', 'rib', 'iban') in references['payment']
+    assert ('customer', 'name') in references['commercial_parties']
+    assert references['table_of_fees'] is None
+
+
+def test_fragment_cache_render(invoice, template_dir, tmpdir):
+    cache = fragments.FragmentCache()
+    other = invoice.copy(update={'reference': '2021-002'})
+    for data in [invoice, other]:
+        generator = invoice_generator.InvoiceGenerator(data,
+                                                       template_dir,
+                                                       output_directory=tmpdir,
+                                                       fragment_cache=cache)
+        generator._load_template()
+        generator._preflight()
+        assert generator._rendered == \
+            generator._template.render(invoice=generator.data)
+    # head reads the reference, the other blocks are shared
+    assert cache.misses == 5
+    assert cache.hits == 3
+
+
+@pytest.fixture
+def store(invoice, tmpdir):
+    invoices = []
+    for i, emited in enumerate([date(2021, 7, 1), date(2021, 9, 30),
+                                date(2021, 10, 1)]):
+        invoices.append(invoice.copy(update={'reference': f'2021-00{i + 1}',
+                                             'emited': emited}))
+    with store_module.InvoiceStore(tmpdir / 'invoices.sqlite') as store:
+        store.add_many(invoices)
+        yield store
+
+
+def test_store_get(store, invoice):
+    assert len(store) == 3
+    assert '2021-001' in store
+    assert store.get('2021-001') == invoice.copy(
+        update={'emited': date(2021, 7, 1)})
+    with pytest.raises(KeyError):
+        store.get('2021-999')
+
+
+def test_store_query(store):
+    q3 = {'emited_from': date(2021, 7, 1), 'emited_to': date(2021, 9, 30)}
+    assert store.references(customer="Dupond's company", **q3) == \
+        ['2021-001', '2021-002']
+    assert [i.reference for i in store.query(issuer='0000000000')] == \
+        ['2021-001', '2021-002', '2021-003']
+    assert store.references(customer='Nobody') == []
+
+
+def test_store_render(store, fake_run, tmpdir):
+    rendered, failed, _ = store.render(tmpdir, emited_from=date(2021, 10, 1))
+    assert list(rendered) == ['2021-003']
+    path, digest = store.rendered('2021-003')
+    assert str(path) == str(tmpdir / '2021-003.pdf')
+    assert digest == store_module.file_hash(path)
+    assert store.rendered('2021-001') is None
+
+
+def test_store_render_options(store, fake_run, tmpdir):
+    cache = fragments.FragmentCache()
+    rendered, _, _ = store.render(tmpdir, customer="Dupond's company",
+                                  layout='hash', fragment_cache=cache)
+    assert len(rendered) == 3
+    assert cache.hits
+    with manifest_module.Manifest(tmpdir) as manifest:
+        entry = manifest.lookup('2021-002')
+    assert store.rendered('2021-002')[0] == entry['path']
+
+
+def test_invoice_generator_layout(generator, tmpdir):
+    assert generator.invoice_directory == tmpdir
+    generator.layout = 'hash'
+    assert generator.invoice_directory == tmpdir / 'a9' / '4a'
+    generator.layout = 'date'
+    emited = generator.data.emited
+    assert generator.invoice_directory == \
+        tmpdir / f'{emited:%Y}' / f'{emited:%m}'
+    with pytest.raises(ValueError):
+        generator.layout = 'random'
+
+
+def test_invoice_generator_run_sharded(generator, fake_run, tmpdir):
+    generator.layout = 'hash'
+    generator.manifest = manifest_module.Manifest(tmpdir)
+    path = generator.run()
+    assert path == tmpdir / 'a9' / '4a' / 'test.pdf'
+    assert os.listdir(tmpdir / 'a9' / '4a') == ['test.pdf']
+    entry = generator.manifest.lookup('2021-001')
+    assert entry['path'] == Path(path)
+    assert entry['size'] == len('2021-001')
+    assert entry['checksum'] == manifest_module.file_hash(path)
+    assert generator.manifest.lookup('2021-002') is None
+
+
+def test_render_batch_layout(invoice, fake_run, tmpdir):
+    rendered, _, _ = batch.render_batch([invoice], tmpdir, layout='date')
+    emited = invoice.emited
+    path = Path(tmpdir) / f'{emited:%Y}' / f'{emited:%m}' / '2021-001.pdf'
+    assert Path(rendered['2021-001']) == path
+    with manifest_module.Manifest(tmpdir) as manifest:
+        assert manifest.lookup('2021-001')['path'] == path
+
+
+@pytest.fixture
+def daemon(fake_run, tmpdir):
+    daemon = server.InvoiceDaemon(tmpdir, workers=2)
+    socket_path = str(tmpdir / 'daemon.sock')
+    thread = threading.Thread(target=daemon.serve_forever,
+                              args=(socket_path,))
+    thread.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    yield socket_path
+    daemon.shutdown()
+    thread.join()
+
+
+def test_invoice_generator_env_shared(generator, template_dir):
+    assert generator._latex_jinja_env is \
+        invoice_generator.latex_jinja_env(template_dir)
+
+
+def test_daemon_render(daemon, invoice, tmpdir):
+    path = client.request(invoice.json(), socket_path=daemon)
+    assert path == str(tmpdir / '2021-001.pdf')
+    content = client.request(json.loads(invoice.json()), 'other',
+                             return_bytes=True, socket_path=daemon)
+    assert content == b'2021-001'
+
+
+def test_daemon_render_error(daemon, invoice):
+    broken = invoice.copy(update={'reference': 'broken'})
+    with pytest.raises(client.RenderError):
+        client.request(broken.json(), socket_path=daemon)
+    with pytest.raises(client.RenderError):
+        client.request({'reference': 'incomplete'}, socket_path=daemon)
+
+
+def test_invoice_generator_preflight_issuer_without_address(invoice,
+                                                            template_dir,
+                                                            tmpdir):
+    invoice.issuer.address = None
+    generator = invoice_generator.InvoiceGenerator(invoice, template_dir,
+                                                   output_directory=tmpdir)
+    generator._load_template()
+    generator._preflight()
+    assert 'Champs de Mars' not in generator._rendered
+
+
+@pytest.fixture
+def edited_template_dir(template_dir, tmpdir):
+    directory = tmpdir / 'templates'
+    shutil.copytree(str(template_dir), str(directory))
+    return directory
+
+
+def _edit_template(path, old, new):
+    with open(path) as f:
+        source = f.read()
+    with open(path, 'w') as f:
+        f.write(source.replace(old, new))
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+
+def test_fragment_cache_template_edited(invoice, edited_template_dir):
+    cache = fragments.FragmentCache()
+    env = invoice_generator.latex_jinja_env(edited_template_dir)
+    assert 'SIRET:' in cache.render(env.get_template('main.tex'), invoice)
+    _edit_template(edited_template_dir / 'base.tex', 'SIRET:', 'Siret :')
+    template = env.get_template('main.tex')
+    rendered = cache.render(template, invoice)
+    assert rendered == template.render(invoice=invoice)
+    assert 'Siret :' in rendered
+
+
+@pytest.mark.parametrize('source', [
+    r"\BLOCK{block head}REF=\VAR{invoice['reference']}"
+    r"\VAR{invoice.customer.name}\BLOCK{endblock}",
+    r"\BLOCK{block head}\BLOCK{set i = invoice}REF=\VAR{i.reference}"
+    r"\VAR{i.customer.name}\BLOCK{endblock}",
+    r"\BLOCK{block head}\BLOCK{set c = invoice.customer}"
+    r"REF=\VAR{invoice.reference}\VAR{c.name}\VAR{invoice.customer.email}"
+    r"\BLOCK{endblock}",
+])
+def test_fragment_cache_opaque_root(invoice, tmpdir, source):
+    with open(tmpdir / 'opaque.tex', 'w') as f:
+        f.write(source)
+    template = invoice_generator.latex_jinja_env(tmpdir) \
+        .get_template('opaque.tex')
+    first = invoice.copy(update={'reference': 'A'})
+    first.customer = first.customer.copy(update={'name': 'alice'})
+    second = invoice.copy(update={'reference': 'B'})
+    second.customer = second.customer.copy(update={'name': 'bob'})
+    cache = fragments.FragmentCache()
+    for data in [first, second]:
+        assert cache.render(template, data) == template.render(invoice=data)
+    assert len(cache) == 0
+
+
+def test_preflight_template_edited(edited_template_dir):
+    env = invoice_generator.latex_jinja_env(edited_template_dir)
+    preflight.check_template(env, 'main.tex')
+    _edit_template(edited_template_dir / 'payment.tex',
+                   'invoice.issuer.rib.bic', 'invoice.issuer.rib.swift')
+    with pytest.raises(preflight.PreflightError):
+        preflight.check_template(env, 'main.tex')
+
+
+def test_render_batch_manifest_escaped_reference(invoice, fake_run, tmpdir):
+    invoice = invoice.copy(update={'reference': 'FAC_2021#1'})
+    rendered, _, _ = batch.render_batch([invoice], tmpdir, layout='hash')
+    with manifest_module.Manifest(tmpdir) as manifest:
+        entry = manifest.lookup('FAC_2021#1')
+    assert entry['path'] == Path(rendered['FAC_2021#1'])
+
+
+def test_batch_safe_name():
+    assert batch.safe_name('FAC_2021_001') == 'FAC_2021_001'
+    assert batch.safe_name('../../somewhere/x') \
+        .startswith('_.._somewhere_x-')
+    names = {batch.safe_name(name)
+             for name in ['FAC/1', 'FAC 1', 'FAC_1', '.x', 'x']}
+    assert len(names) == 5
+    with pytest.raises(ValueError):
+        batch.safe_name('..')
+
+
+def test_render_batch_similar_references(invoice, journal, fake_run, tmpdir):
+    invoices = [invoice.copy(update={'reference': reference})
+                for reference in ['FAC/1', 'FAC 1', 'FAC_1']]
+    rendered, failed, _ = batch.render_batch(invoices, tmpdir,
+                                             journal=journal)
+    assert not failed
+    contents = set()
+    for path in set(rendered.values()):
+        with open(path) as f:
+            contents.add(f.read())
+    assert len(contents) == 3
+
+
+def test_daemon_render_unsafe_name(daemon, invoice, tmpdir):
+    path = client.request(invoice.json(), '../../somewhere/x',
+                          socket_path=daemon)
+    assert path == str(tmpdir / (batch.safe_name('../../somewhere/x') +
+                                 '.pdf'))
+    assert path.startswith(str(tmpdir / '_.._somewhere_x-'))
+
+
+def test_daemon_render_same_name(daemon, invoice, monkeypatch):
+    running = []
+    compile_latex = invoice_generator.InvoiceGenerator._compile_latex
+
+    def serialized_compile_latex(self):
+        running.append(self.invoice_name)
+        assert running.count(self.invoice_name) == 1
+        time.sleep(0.05)
+        compile_latex(self)
+        running.remove(self.invoice_name)
+        return self
+    monkeypatch.setattr(invoice_generator.InvoiceGenerator, '_compile_latex',
+                        serialized_compile_latex)
+    with ThreadPoolExecutor(2) as pool:
+        paths = list(pool.map(lambda _: client.request(invoice.json(),
+                                                       socket_path=daemon),
+                              range(2)))
+    assert paths[0] == paths[1]
+
+
+def test_daemon_render_same_name_bytes(daemon, invoice):
+    invoices = [invoice.copy(update={'reference': f'2021-{i:03d}'}).json()
+                for i in range(20)]
+    with ThreadPoolExecutor(4) as pool:
+        contents = list(pool.map(
+            lambda data: client.request(data, 'same', return_bytes=True,
+                                        socket_path=daemon),
+            invoices))
+    assert contents == [f'2021-{i:03d}'.encode() for i in range(20)]